@@ -6,12 +6,62 @@ VERSION: Robust (Hedgefonds-Analyst mit CoinGecko -> Tavily Fallback)
 
 import os
 import json
+import time
 import requests
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 import yfinance as yf
 import google.generativeai as genai
 from tavily import TavilyClient
 
+# --- Gesprächskontext (Multi-Turn) ---
+# Grobe Schätzung: ~4 Zeichen pro Token reichen für die Budgetierung aus.
+CHARS_PER_TOKEN = 4
+# Budget für den wörtlich übernommenen Verlauf der letzten Nachrichten
+HISTORY_TOKEN_BUDGET = 2000
+# Maximale Anzahl der wörtlich übernommenen Nachrichten (User + Assistant)
+MAX_RECENT_MESSAGES = 6
+# Obergrenze für die rollierende Zusammenfassung älterer Nachrichten
+SUMMARY_TOKEN_BUDGET = 400
+# Aus dem Fenster gefallene Nachrichten werden gebündelt zusammengefasst (spart Gemini-Aufrufe):
+# erst ab so vielen Nachrichten bzw. Tokens, bis dahin bleiben sie wörtlich im Kontext.
+SUMMARY_BATCH_MESSAGES = 6
+SUMMARY_BATCH_TOKENS = 1500
+# Budget für wiederverwendete Daten aus früheren Fragen
+CONTEXT_DATA_TOKEN_BUDGET = 3000
+# Nur diese Aktionen liefern Daten für Folgefragen ('earlier_turn_data')
+COMPARABLE_ACTIONS = ("get_stock_data", "get_crypto_data")
+# Wie lange bereits geholte Daten als "frisch" gelten (Sekunden)
+DATA_TTL_SECONDS = {
+    "search_web": 60 * 60,
+    "get_stock_data": 15 * 60,
+    "get_crypto_data": 5 * 60,
+    "get_economic_indicators": 15 * 60,
+}
+MAX_CACHED_RESULTS = 10
+
+
+def estimate_tokens(text: str) -> int:
+    """Schätzt die Token-Anzahl eines Textes (ohne Tokenizer-Aufruf)."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def shorten_text(text: str, max_chars: int) -> str:
+    """Kürzt einen Text auf max_chars, geschnitten an einer Zeilen- oder Wortgrenze."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    if boundary > 0:
+        cut = cut[:boundary]
+    return cut.rstrip() + " …"
+
+
+def format_messages(messages: List[Dict]) -> str:
+    """Formatiert Chat-Nachrichten als einfachen Text für den Prompt."""
+    labels = {"user": "Nutzer", "assistant": "Assistent"}
+    return "\n\n".join(f"{labels.get(m.get('role'), m.get('role'))}: {m.get('content', '')}" for m in messages)
+
+
 class FinancialAgent:
     """
     Financial Research Agent powered by Google Gemini Flash
@@ -203,7 +253,7 @@ class FinancialAgent:
             return {"error": f"Failed to fetch economic indicators: {str(e)}"}
 
     # --- HIER IST DIE ÄNDERUNG (Angepasster Prompt) ---
-    def analyze_with_gemini(self, query: str, data: Dict) -> str:
+    def analyze_with_gemini(self, query: str, data: Dict, conversation: str = "") -> str:
         """Nutzt Gemini für intelligente Analyse"""
         
         # Angepasster "Hedgefonds-Analyst" Prompt
@@ -223,9 +273,21 @@ class FinancialAgent:
         - Wenn 'tavily_fallback_data' auch keine Infos liefert, melde, dass keine Daten gefunden wurden.
         - ERFINDE NIEMALS Daten.
         - Gib immer die Quelle an ("Laut CoinGecko...", "Laut Tavily Web-Suche...").
+        
+        GESPRÄCHSKONTEXT:
+        - Falls ein bisheriger Gesprächsverlauf mitgeliefert wird, nutze ihn, um Folgefragen zu verstehen (z.B. "und im Vergleich zu Tesla?").
+        - 'earlier_turn_data' enthält noch aktuelle Aktien-/Krypto-Daten, die für frühere Fragen dieses Chats geholt wurden. Nutze sie für Vergleiche und Folgefragen (z.B. bezieht sich "Wie hoch ist das KGV?" auf das zuvor besprochene Asset).
+        - Zahlen und Fakten entnimmst du NUR den gelieferten Daten (inkl. 'earlier_turn_data'), nicht dem Gesprächsverlauf.
         """
         
-        user_prompt = f"""
+        conversation_block = ""
+        if conversation:
+            conversation_block = f"""
+        Bisheriger Gesprächsverlauf:
+        {conversation}
+        """
+        
+        user_prompt = f"""{conversation_block}
         Nutzer-Frage: {query}
         
         Verfügbare Daten (aus APIs und Web-Suche):
@@ -245,6 +307,105 @@ class FinancialAgent:
             return f"Error generating analysis: {str(e)}"
     
     
+    def summarize_messages(self, previous_summary: str, messages: List[Dict]) -> str:
+        """Arbeitet neue Nachrichten inkrementell in die bestehende Zusammenfassung ein."""
+        max_words = SUMMARY_TOKEN_BUDGET * 3 // 4
+        prompt = f"""Fasse den Verlauf eines Finanz-Chats knapp auf Deutsch zusammen (höchstens {max_words} Wörter).
+        Behalte genannte Aktien, Kryptowährungen, Ticker, Zeiträume, Kernaussagen und offene Fragen des Nutzers.
+        
+        Bisherige Zusammenfassung:
+        {previous_summary or "(noch keine)"}
+        
+        Neue Nachrichten:
+        {format_messages(messages)}
+        
+        Gib nur die aktualisierte Zusammenfassung zurück.
+        """
+        max_chars = SUMMARY_TOKEN_BUDGET * CHARS_PER_TOKEN
+        try:
+            summary = self.model.generate_content(prompt).text.strip()
+        except Exception as e:
+            print(f"❌ Summary generation failed: {e}")
+            # Fallback: alte Zusammenfassung behalten, neue Nachrichten auf das Restbudget kürzen
+            remaining = max_chars - len(previous_summary)
+            if remaining <= 0:
+                return previous_summary
+            per_message = remaining // len(messages)
+            shortened = [{**m, "content": shorten_text(m.get("content", ""), per_message)} for m in messages]
+            summary = f"{previous_summary}\n{format_messages(shortened)}".strip()
+        # Harte Obergrenze, falls das Modell sich nicht an die Länge hält
+        return shorten_text(summary, max_chars)
+
+    def build_conversation_context(self, chat: Dict, history: List[Dict]) -> Tuple[str, int]:
+        """
+        Baut den Gesprächskontext mit festem Token-Budget:
+        rollierende Zusammenfassung älterer Nachrichten + die letzten Nachrichten wörtlich.
+        Die Zusammenfassung wird im Chat-Dokument gecacht ('context_summary',
+        'summarized_messages') und nur erweitert, wenn genug Nachrichten aus dem Fenster gefallen sind.
+        Gibt den Kontext-Text und den Index der ersten wörtlich übernommenen Nachricht zurück.
+        """
+        summarized = chat.get("summarized_messages", 0)
+        summary = chat.get("context_summary", "")
+
+        # Verlauf wurde gelöscht -> Zusammenfassung und Daten-Cache verwerfen
+        if summarized > len(history):
+            summarized, summary = 0, ""
+            chat["data_cache"] = []
+
+        # Fenster der letzten Nachrichten rückwärts bis zum Budget füllen
+        window_start = len(history)
+        used_tokens = 0
+        while window_start > summarized and len(history) - window_start < MAX_RECENT_MESSAGES:
+            tokens = estimate_tokens(history[window_start - 1].get("content", ""))
+            if used_tokens + tokens > HISTORY_TOKEN_BUDGET:
+                break
+            used_tokens += tokens
+            window_start -= 1
+
+        # Aus dem Fenster gefallene Nachrichten gebündelt zusammenfassen;
+        # solange der Stapel klein ist, bleiben sie wörtlich im Kontext.
+        pending = history[summarized:window_start]
+        pending_tokens = sum(estimate_tokens(m.get("content", "")) for m in pending)
+        if len(pending) >= SUMMARY_BATCH_MESSAGES or (pending and pending_tokens >= SUMMARY_BATCH_TOKENS):
+            print(f"📝 Summarizing messages {summarized}-{window_start - 1}...")
+            summary = self.summarize_messages(summary, pending)
+            summarized = window_start
+        else:
+            window_start = summarized
+
+        chat["context_summary"] = summary
+        chat["summarized_messages"] = summarized
+
+        parts = []
+        if summary:
+            parts.append(f"Zusammenfassung des früheren Verlaufs:\n{summary}")
+        if window_start < len(history):
+            parts.append(f"Letzte Nachrichten:\n{format_messages(history[window_start:])}")
+        return "\n\n".join(parts), window_start
+
+    def _cache_key(self, step: Dict) -> str:
+        return json.dumps({"action": step.get("action"), "params": step.get("params", {})}, sort_keys=True)
+
+    def _is_fresh(self, entry: Dict, now: float) -> bool:
+        ttl = DATA_TTL_SECONDS.get(entry.get("action"), 0)
+        return now - entry.get("fetched_at", 0) < ttl
+
+    def _is_cacheable(self, action: str, result) -> bool:
+        """Fehlerhafte Ergebnisse (egal in welcher Form) werden nicht gecacht."""
+        if isinstance(result, list):
+            return not any(isinstance(item, dict) and "error" in item for item in result)
+        if not isinstance(result, dict) or result.get("error"):
+            return False
+        if action == "get_crypto_data":
+            # Nur verwerfen, wenn weder CoinGecko noch der Tavily-Fallback Daten liefern
+            coingecko = result.get("coingecko_data") or {}
+            fallback = result.get("tavily_fallback_data") or {}
+            coingecko_ok = not coingecko.get("error") and coingecko.get("current_price_eur") not in ("N/A", None)
+            fallback_ok = bool(fallback) and not fallback.get("error") and self._is_cacheable(
+                "search_web", fallback.get("results", []))
+            return coingecko_ok or fallback_ok
+        return True
+
     def execute_step(self, step: Dict) -> Dict:
         """Führt einen Research-Schritt aus"""
         # (Diese Funktion ist unverändert)
@@ -264,14 +425,39 @@ class FinancialAgent:
         else:
             return {"error": f"Unknown action: {action}"}
     
-    # --- 'run' Funktion mit regelbasierter Logik (unverändert) ---
-    def run(self, query: str) -> str:
-        """Hauptfunktion: Führt die komplette Analyse durch (OHNE Planungs-KI)"""
+    # --- 'run' Funktion mit regelbasierter Logik (+ optionaler Gesprächskontext) ---
+    def run(self, query: str, chat: Optional[Dict] = None) -> str:
+        """
+        Hauptfunktion: Führt die komplette Analyse durch (OHNE Planungs-KI)
+        
+        Optional kann das Chat-Dokument übergeben werden ('history' enthält die aktuelle
+        Frage bereits als letzte Nachricht). Dann werden Verlauf, rollierende Zusammenfassung
+        und noch frische Daten früherer Fragen genutzt; der Cache wird im Dokument aktualisiert.
+        """
         print(f"\n{'='*80}\n❓ Query: {query}\n")
         
+        conversation = ""
+        data_cache = {}
+        history = []
+        window_start = 0
+        now = time.time()
+        if chat is not None:
+            history = list(chat.get("history", []))
+            if history and history[-1].get("role") == "user" and history[-1].get("content") == query:
+                history = history[:-1]
+            # Fehlermeldungen der App sind kein Gesprächsinhalt (Indizes beziehen sich auf die gefilterte Liste)
+            history = [m for m in history if not m.get("error")]
+            conversation, window_start = self.build_conversation_context(chat, history)
+            # Abgelaufene oder fehlerhafte Daten verwerfen
+            data_cache = {
+                e["key"]: e for e in chat.get("data_cache", [])
+                if self._is_fresh(e, now) and self._is_cacheable(e.get("action"), e.get("result"))
+            }
+        
         query_lower = query.lower()
         collected_data = {}
         steps = [] # Liste der auszuführenden Schritte
+        general_question = False
 
         # --- Start der "dummen", aber zuverlässigen Planungs-Logik ---
         print("📋 Executing rules-based planning...")
@@ -279,6 +465,7 @@ class FinancialAgent:
         # Regel 1: Allgemeine Fragen ("was ist", "erkläre", "definition", "wer ist", "nachrichten")
         if any(kw in query_lower for kw in ["was ist", "erkläre", "definition", "wer ist", "nachrichten zu", "news"]):
             print("Rule 1: General question. Planning search_web.")
+            general_question = True
             steps.append({"action": "search_web", "params": {"query": query}, "reason": "General question"})
 
         # Regel 2: Krypto (mit Fallback auf Suche)
@@ -315,16 +502,58 @@ class FinancialAgent:
 
         # 2. Schritte ausführen
         print("🔬 Executing research steps...")
+        planned_keys = set()
         for i, step in enumerate(steps, 1):
             print(f"\nStep {i}/{len(steps)}: {step.get('reason', 'No reason provided')}")
-            result = self.execute_step(step)
+            key = self._cache_key(step)
+            planned_keys.add(key)
+            if key in data_cache:
+                print(f"♻️ Reusing cached data for {step.get('action')}")
+                result = data_cache[key]["result"]
+                data_cache[key]["turn"] = len(history)
+            else:
+                result = self.execute_step(step)
+                if chat is not None and self._is_cacheable(step.get("action"), result):
+                    data_cache[key] = {
+                        "key": key,
+                        "action": step.get("action"),
+                        "params": step.get("params", {}),
+                        # JSON-Roundtrip, damit das Ergebnis sicher in Firestore gespeichert werden kann
+                        "result": json.loads(json.dumps(result, default=str)),
+                        "fetched_at": now,
+                        "turn": len(history),
+                    }
             collected_data[f"step_{i}_{step.get('action')}"] = result
         
+        # Noch frische Aktien-/Krypto-Daten aus den letzten Fragen als Kontext: für Vergleiche
+        # (auch über Anlageklassen hinweg) und Folgefragen ohne eigenes Asset ("Wie hoch ist das KGV?").
+        # Allgemeine Fragen (Regel 1, z.B. "Was ist ein ETF?") bekommen keine früheren Daten.
+        if chat is not None and not general_question:
+            earlier = {}
+            used_tokens = 0
+            for key, entry in sorted(data_cache.items(), key=lambda kv: kv[1]["fetched_at"], reverse=True):
+                if key in planned_keys or entry.get("action") not in COMPARABLE_ACTIONS or entry.get("turn", -1) < window_start:
+                    continue
+                tokens = estimate_tokens(json.dumps(entry["result"], default=str))
+                if used_tokens + tokens > CONTEXT_DATA_TOKEN_BUDGET:
+                    continue
+                used_tokens += tokens
+                earlier[f"{entry['action']}({json.dumps(entry['params'], sort_keys=True)})"] = entry["result"]
+            if earlier:
+                print(f"♻️ Adding {len(earlier)} results from earlier turns as context")
+                collected_data["earlier_turn_data"] = earlier
+        
+        if chat is not None:
+            # Als Liste speichern: Firestore ersetzt Arrays bei set(merge=True) komplett,
+            # verworfene Einträge verschwinden so auch aus dem Dokument.
+            newest = sorted(data_cache.values(), key=lambda e: e["fetched_at"], reverse=True)
+            chat["data_cache"] = newest[:MAX_CACHED_RESULTS]
+        
         print("\n✅ All steps executed\n")
 
-        # 3. Gemini-Analyse (Nur noch 1 API-Aufruf pro Chat-Frage)
+        # 3. Gemini-Analyse (1 Analyse-Aufruf pro Chat-Frage; Zusammenfassungen nur gebündelt alle paar Fragen)
         print("🤖 Generating analysis with Gemini...")
-        analysis = self.analyze_with_gemini(query, collected_data)
+        analysis = self.analyze_with_gemini(query, collected_data, conversation)
         
         print(f"\n{'='*80}\n📈 ANALYSIS\n{'='*80}\n{analysis}\n{'='*80}\n")
         
@@ -121,10 +121,10 @@ def save_chat_name_to_db(chat_index, new_name):
     doc_ref.update({"name": new_name})
 
 def delete_chat_history_in_db(chat_index):
-    """Löscht nur den Verlauf ('history') eines Chats in Firestore."""
+    """Löscht den Verlauf ('history') eines Chats samt Zusammenfassung und Daten-Cache in Firestore."""
     print(f"Lösche Verlauf von Chat {chat_index}...")
     doc_ref = db.collection("users").document(USER_ID).collection("chats").document(f"chat_{chat_index}")
-    doc_ref.update({"history": []})
+    doc_ref.update({"history": [], "context_summary": "", "summarized_messages": 0, "data_cache": []})
 
 
 # --- HAUPT-ANWENDUNG (Rest unverändert) ---
@@ -174,7 +174,8 @@ def run_app():
 
         st.markdown("---")
         if st.button("Aktuellen Chat löschen", type="primary"):
-            st.session_state.chats[st.session_state.active_chat_index]["history"] = []
+            active_chat = st.session_state.chats[st.session_state.active_chat_index]
+            active_chat.update({"history": [], "context_summary": "", "summarized_messages": 0, "data_cache": []})
             delete_chat_history_in_db(st.session_state.active_chat_index)
             st.rerun()
 
@@ -214,7 +215,8 @@ def run_app():
         with st.chat_message("assistant"):
             with st.spinner("Agent recherchiert..."):
                 try:
-                    response = agent.run(query) 
+                    # Chat-Dokument mitgeben: Agent nutzt Verlauf und aktualisiert Zusammenfassung/Daten-Cache
+                    response = agent.run(query, chat=st.session_state.chats[st.session_state.active_chat_index])
                     st.markdown(response)
                     assistant_message = {"role": "assistant", "content": response}
                     st.session_state.chats[st.session_state.active_chat_index]["history"].append(assistant_message)
@@ -222,7 +224,8 @@ def run_app():
                 except Exception as e:
                     error_msg = f"Ein Fehler ist aufgetreten: {e}"
                     st.error(error_msg)
-                    error_message = {"role": "assistant", "content": error_msg}
+                    # "error"-Markierung: Agent lässt diese Nachricht im Gesprächskontext weg
+                    error_message = {"role": "assistant", "content": error_msg, "error": True}
                     st.session_state.chats[st.session_state.active_chat_index]["history"].append(error_message)
                     save_chat_to_db(st.session_state.active_chat_index, st.session_state.chats[st.session_state.active_chat_index])
 